@@ -1,6 +1,7 @@
-import sys, json, sqlite3, openai, tiktoken, numpy as np
+import sys, json, time, sqlite3, openai, tiktoken, numpy as np
 from flask import Flask, request, Response, stream_with_context
 from text_tools import get_document_paragraphs
+from llm_gateway import LLM_Gateway, retryable_errors
 
 # Import course settings based on parameter passed
 with open('courses.json','r') as courses_file: 
@@ -14,44 +15,92 @@ class DB_Search:
     def __init__(self, db_file):
         self.db_file = db_file
         self.documents = self.load_documents()
-        self.embeddings_dict = self.load_embeddings()
+        self.doc_ids = { document["file_path"]: document["doc_id"] for document in self.documents }
+        self.chunk_ids, self.chunk_embeddings, self.chunk_doc_ids = self.load_embeddings()
+        self.doc_chunk_rows = self.group_chunks_by_document()
+        self.centroid_doc_ids, self.centroids = self.build_centroid_index()
 
     # Load the filenames and LLM-descriptions of all training documents from the database into a dictionary
     def load_documents(self):
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
-        cursor.execute('SELECT file_path, description FROM documents')
+        cursor.execute('SELECT doc_id, file_path, description FROM documents')
         data = cursor.fetchall()
         conn.close()
-        documents = [ { "file_path":row[0] , "description":row[1] } for row in data ]
+        documents = [ { "doc_id":row[0] , "file_path":row[1] , "description":row[2] } for row in data ]
         return documents
 
-    # Load the ids and vector embddings of the text chunks that were built from the training data, but NOT the text itself to limit memory usage.
+    # Load the ids, document ids and vector embddings of the text chunks that were built from the training data, but NOT the text itself to limit memory usage.
+    # The embeddings are stacked into one matrix (one row per chunk) so that a whole document's chunks can be scored with a single matrix product.
     def load_embeddings(self):
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
-        cursor.execute('SELECT id, embedding FROM chunks')
+        cursor.execute('SELECT id, doc_id, embedding FROM chunks ORDER BY doc_id, id')
         data = cursor.fetchall()
         conn.close()
-        embeddings_dict = {row[0]: np.array( np.frombuffer(row[1]) ) for row in data}
-        return embeddings_dict
+        chunk_ids = np.array( [row[0] for row in data] )
+        chunk_doc_ids = np.array( [row[1] for row in data] )
+        chunk_embeddings = np.array( [np.frombuffer(row[2]) for row in data] )
+        return chunk_ids, chunk_embeddings, chunk_doc_ids
+
+    # Map each document id to the rows of its chunks in self.chunk_embeddings. Since chunks are loaded sorted by document, each document is one contiguous slice.
+    def group_chunks_by_document(self):
+        doc_chunk_rows = {}
+        doc_ids, starts, counts = np.unique(self.chunk_doc_ids, return_index=True, return_counts=True)
+        for doc_id, start, count in zip(doc_ids, starts, counts):
+            doc_chunk_rows[doc_id.item()] = slice(start, start + count)
+        return doc_chunk_rows
+
+    # Build a second, much smaller index with one vector per document: the normalized mean of its chunk embeddings.
+    # Searching this first lets retrieval narrow down to a few documents before scoring any individual chunks.
+    def build_centroid_index(self):
+        centroid_doc_ids = np.array( list(self.doc_chunk_rows.keys()) )
+        if not len(centroid_doc_ids): return centroid_doc_ids, np.empty((0, 0))
+        centroids = np.array( [ self.chunk_embeddings[rows].mean(axis=0) for rows in self.doc_chunk_rows.values() ] )
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        return centroid_doc_ids, centroids
+
+    # Choose which documents' chunks to score. With scope="within", only the given document is searched; with scope="exclude", it is skipped
+    # (e.g. because its full text is already in the prompt). If num_documents is set, only the documents whose centroids best match the query are kept.
+    # An unknown document (e.g. a file path the LLM made up) or one with no chunks gives nothing to search within.
+    def candidate_documents(self, query_embedding, document=None, scope="all", num_documents=None):
+        if scope not in ("all", "within", "exclude"): raise ValueError(f"Unknown search scope: {scope}")
+        doc_id = self.doc_ids.get(document)
+        if scope == "within": return [doc_id] if doc_id in self.doc_chunk_rows else []
+        doc_ids = self.centroid_doc_ids
+        centroids = self.centroids
+        if scope == "exclude" and doc_id is not None:
+            keep = doc_ids != doc_id
+            doc_ids, centroids = doc_ids[keep], centroids[keep]
+        if num_documents is not None and num_documents < len(doc_ids):
+            top_documents = np.argpartition( -(centroids @ query_embedding), num_documents )[:num_documents]
+            doc_ids = doc_ids[top_documents]
+        return doc_ids.tolist()
 
     # Perform semantic search on the embeddings, and read the text of the top k results directly from the database.
-    def retrieve_context(self, keywords, k=5):
+    # See candidate_documents() for document, scope and num_documents; by default every chunk in the course is searched.
+    # deadline is the number of seconds the query embedding may spend queueing in the LLM gateway.
+    def retrieve_context(self, keywords, k=5, document=None, scope="all", num_documents=None, deadline=None):
         # To do: I would like to loop over the keywords and do a semantic search on each separately, 
         # and then rerank to prioritize those matching earlier keywords, those from lecture materials as opposed to outside materials, and those with higher match quality,
         # but need to think about the exact way to encode all of that.
         keywords_list = ', '.join(keywords)
         # get embeddings of the query
-        query_embedding = np.array( openai.embeddings.create(model="text-embedding-ada-002",input=keywords_list).data[0].embedding )
+        query_embedding = np.array( gateway.embed(model="text-embedding-ada-002",input=keywords_list,deadline=deadline).data[0].embedding )
         # using FAISS index: if I want to do this, create the index in the __init__ method above.
         # distances_array, indices_array = index.search(query_embedding, k)
-        # alternatively, just do it by hand
-        similarities = {}
-        for chunk_id, embedding in self.embeddings_dict.items():
-            # Uncomment the end of the line to switch from inner product similarity to cosine similarity. 
-            similarities[chunk_id] = np.dot( embedding, query_embedding ) # / ( np.linalg.norm( embedding ) * np.linalg.norm( query_embedding ) )
-        top_k_ids = sorted(similarities, key=similarities.get, reverse=True)[:k]
+        # alternatively, just do it by hand: first pick the documents to search, then score only their chunks.
+        doc_ids = self.candidate_documents(query_embedding, document, scope, num_documents)
+        if not doc_ids: return ""
+        # Inner product similarity. Divide by np.linalg.norm( embeddings, axis=1 ) * np.linalg.norm( query_embedding ) to switch to cosine similarity.
+        if len(doc_ids) == len(self.doc_chunk_rows):
+            # Every document is a candidate, so score the whole matrix rather than copying it row by row.
+            rows = np.arange(len(self.chunk_ids))
+            similarities = self.chunk_embeddings @ query_embedding
+        else:
+            rows = np.concatenate( [ np.arange(self.doc_chunk_rows[doc_id].start, self.doc_chunk_rows[doc_id].stop) for doc_id in doc_ids ] )
+            similarities = self.chunk_embeddings[rows] @ query_embedding
+        top_k_ids = self.chunk_ids[ rows[ np.argsort(-similarities)[:k] ] ].tolist()
         # retrieve the actual text chunks from the database
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
@@ -68,10 +117,17 @@ class DB_Search:
 db_search = DB_Search(db_path)
 
 # 2. Set up functions to build prompt and query LLM
-client = openai.OpenAI()
+# All LLM calls go through one shared gateway, which limits concurrency and tokens per minute for each model, queues and retries requests,
+# and merges identical requests that are in flight at the same time. The limits apply to this server only (see gateway_processes in llm_gateway.py),
+# and can be overridden per course with "llm_limits" in courses.json.
+gateway = LLM_Gateway(model_limits=course_data.get('llm_limits'))
 no_selection_text = "No selection."
+busy_text = "\n\nSorry, the TA service is very busy right now. Please try again in a minute."
+error_text = "\n\nSorry, something went wrong while answering this question. Trying again will not help; please rephrase it, or ask about a smaller part of the material."
+# Number of documents (picked by centroid) whose chunks are scored in semantic search. Set to None to score every chunk in the course.
+search_num_documents = 10
 
-def document_prompt(query,chat_history_messages):
+def document_prompt(query,chat_history_messages,request_deadline):
     helper_query_system_string = (
     f"I am teaching a college course on {course_data['topic']}.  "
     "A student has been having a conversation with a teaching assistant, and has just asked a question.  "
@@ -113,11 +169,12 @@ def document_prompt(query,chat_history_messages):
                                 + annotated_messages 
                                 + [{"role":"user","content":annotated_query}] )
     # print("############## SENDING FIRST PROMPT")
-    helper_query_response = client.chat.completions.create(
+    helper_query_response = gateway.chat(
         model="gpt-4o-mini",
         messages=helper_query_messages,
         max_tokens=100,
-        stream=False
+        stream=False,
+        deadline=request_deadline-time.monotonic()
     )
     # print("############## RESPONSE RECEIVED")
 
@@ -135,7 +192,7 @@ def document_prompt(query,chat_history_messages):
 
     return document_choice
 
-def keyword_prompt(query,chat_history_messages,document_choice):
+def keyword_prompt(query,chat_history_messages,document_choice,request_deadline):
     helper_query_string = (
     f"I am teaching a college course on {course_data['topic']}.  "
     "A student has been having a conversation with a teaching assistant, and has just asked a question.  "
@@ -178,11 +235,12 @@ def keyword_prompt(query,chat_history_messages,document_choice):
 
     helper_query_messages = [{"role":"system","content":helper_query_string+context_string}] + annotated_messages + [{"role":"user","content":annotated_query}]
     # print("############## SENDING SECOND PROMPT")
-    helper_query_response = client.chat.completions.create(
+    helper_query_response = gateway.chat(
         model="gpt-4o-mini",
         messages=helper_query_messages,
         max_tokens=100,
-        stream=False
+        stream=False,
+        deadline=request_deadline-time.monotonic()
     )
     # print("############## RESPONSE RECEIVED")
 
@@ -200,58 +258,75 @@ def keyword_prompt(query,chat_history_messages,document_choice):
 
 def query_LLM(query,chat_history_messages):
 
-    context_string = ""
+    # One deadline for the whole request, shared by all of the gateway calls below, so that a busy gateway cannot make a student wait for each call in turn.
+    request_deadline = time.monotonic() + gateway.deadline
+    try:
+        context_string = ""
 
-    # Prompt 1: Have the LLM request a course document that would be useful.
-    document_choice = document_prompt(query,chat_history_messages)
-    # print(document_choice)
-    if document_choice != no_selection_text and document_choice != no_selection_text.rstrip('.'):
-        try:
-            document_paragraphs = get_document_paragraphs(document_choice)
-            document_text = '\n\n'.join(document_paragraphs)
-            context_string += "Here is the course document that you already selected as being most useful to answer the student's question:\n"+document_choice+'\n'+document_text+'\n'
-        except FileNotFoundError:
-            pass
-    # print(context_string)
+        # Prompt 1: Have the LLM request a course document that would be useful.
+        document_choice = document_prompt(query,chat_history_messages,request_deadline)
+        # print(document_choice)
+        # Keep track of whether the chosen document was pasted in full, so that semantic search below does not return chunks of it again.
+        pasted_document = None
+        if document_choice != no_selection_text and document_choice != no_selection_text.rstrip('.'):
+            try:
+                document_paragraphs = get_document_paragraphs(document_choice)
+                document_text = '\n\n'.join(document_paragraphs)
+                context_string += "Here is the course document that you already selected as being most useful to answer the student's question:\n"+document_choice+'\n'+document_text+'\n'
+                pasted_document = document_choice
+            except FileNotFoundError:
+                pass
+        # print(context_string)
 
-    # Prompt 2: Have the LLM request keywords that would be useful in semantic search, given the document it already chose.
-    keywords = keyword_prompt(query,chat_history_messages,document_choice)
-    other_context = db_search.retrieve_context(keywords)
-    context_string += "\nHere is some other content from the course materials that is related to the student's question:\n"+other_context
+        # Prompt 2: Have the LLM request keywords that would be useful in semantic search, given the document it already chose.
+        keywords = keyword_prompt(query,chat_history_messages,document_choice,request_deadline)
+        other_context = db_search.retrieve_context(keywords, document=pasted_document, scope="exclude", num_documents=search_num_documents, deadline=request_deadline-time.monotonic())
+        context_string += "\nHere is some other content from the course materials that is related to the student's question:\n"+other_context
     
-    # Prompt 3: Have the LLM build an answer based on the document and keywords.
-    ai_answer_query_system_string = (
-    f"You are a helpful TA answering student questions in a college course on {course_data['topic']}. "
-    "You refuse to answer questions about people or topics that are not mentioned in the course materials provided below. "
-    "You also refuse to give any information about other students in the class. "
-    "Below is some information from the course documents that will be useful in answering the student's question. "
-    "You can use outside information as well, but the information I provide is always more reliable. "
-    "\n\n"
-    )
+        # Prompt 3: Have the LLM build an answer based on the document and keywords.
+        ai_answer_query_system_string = (
+        f"You are a helpful TA answering student questions in a college course on {course_data['topic']}. "
+        "You refuse to answer questions about people or topics that are not mentioned in the course materials provided below. "
+        "You also refuse to give any information about other students in the class. "
+        "Below is some information from the course documents that will be useful in answering the student's question. "
+        "You can use outside information as well, but the information I provide is always more reliable. "
+        "\n\n"
+        )
 
-    ai_answer_query_messages = [{"role":"system","content":ai_answer_query_system_string+context_string}] + chat_history_messages + [{"role":"user","content":query}]
-    # print("############ SENDING THIRD PROMPT")
-    ai_response_stream = client.chat.completions.create(
-        model="gpt-4o",
-        messages=ai_answer_query_messages,
-        max_tokens=2000,
-        stream=True,
-        stream_options={"include_usage":True}
-    )
-    # print("############ RESPONSE RECEIVED")
-
-    # Retrieve just the text from each chunk in the response stream, serialize with JSON, and yield it as output
-    for chunk in ai_response_stream:
-        # With include_usage set to true above, an extra token is added to the end of the stream to give usage statistics
-        if chunk.usage:
-            print("Usage statistics, third prompt:") 
-            print(f"          Prompt tokens used: {chunk.usage.prompt_tokens}") 
-            print(f"          Completion tokens used: {chunk.usage.completion_tokens}") 
-            print(f"          Total tokens used: {chunk.usage.total_tokens}") 
-            return
-        chunk_content = chunk.choices[0].delta.content
-        if chunk_content:
-            yield json.dumps({"token": chunk_content})+'\n'
+        ai_answer_query_messages = [{"role":"system","content":ai_answer_query_system_string+context_string}] + chat_history_messages + [{"role":"user","content":query}]
+        # print("############ SENDING THIRD PROMPT")
+        ai_response_stream = gateway.chat(
+            model="gpt-4o",
+            messages=ai_answer_query_messages,
+            max_tokens=2000,
+            stream=True,
+            stream_options={"include_usage":True},
+            deadline=request_deadline-time.monotonic()
+        )
+        # print("############ RESPONSE RECEIVED")
+
+        # Retrieve just the text from each chunk in the response stream, serialize with JSON, and yield it as output
+        # Closing the stream on the way out (including the early return below) releases its slot in the gateway and the upstream connection.
+        with ai_response_stream:
+            for chunk in ai_response_stream:
+                # With include_usage set to true above, an extra token is added to the end of the stream to give usage statistics
+                if chunk.usage:
+                    print("Usage statistics, third prompt:") 
+                    print(f"          Prompt tokens used: {chunk.usage.prompt_tokens}") 
+                    print(f"          Completion tokens used: {chunk.usage.completion_tokens}") 
+                    print(f"          Total tokens used: {chunk.usage.total_tokens}") 
+                    return
+                chunk_content = chunk.choices[0].delta.content
+                if chunk_content:
+                    yield json.dumps({"token": chunk_content})+'\n'
+    # These happen after Flask has already started the response, so tell the student instead of cutting the answer off with no explanation.
+    # Only capacity problems are worth retrying; other API errors (e.g. a prompt over the context length) will fail the same way again.
+    except (TimeoutError, *retryable_errors) as error:
+        print(f"LLM request failed: {error!r}")
+        yield json.dumps({"token": busy_text})+'\n'
+    except openai.APIError as error:
+        print(f"LLM request failed: {error!r}")
+        yield json.dumps({"token": error_text})+'\n'
 
 # 3. Flask code
 
@@ -269,5 +344,10 @@ def get_response():
     # Wrap the generator in Flask objects to stream content back to the API
     return Response( stream_with_context( LLM_response ), content_type='text/event-stream')
 
+# Queue depth, wait times and retry counts for each model, to help size capacity.
+@app.route('/gateway_stats',methods=['GET'])
+def gateway_stats():
+    return gateway.stats()
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1',port=course_data['api_port'])
@@ -1,4 +1,4 @@
-import sys, os, openai, sqlite3, json
+import sys, os, sqlite3, json
 
 import numpy as np
 
@@ -8,14 +8,18 @@ from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
 
 from text_tools import get_document_paragraphs, chunk_paragraphs
-
-client = openai.OpenAI()
+from llm_gateway import LLM_Gateway
 
 # Import course settings based on parameter passed
 with open('courses.json','r') as courses_file: 
     course_data = json.load(courses_file).get( sys.argv[1] ,{})
 if not course_data: raise ValueError(f"No course data found for {sys.argv[1]}")
 
+# Shared by all worker threads below, so the per-model limits apply to the whole build rather than to each thread.
+# Like each back.py server, this process gets its own share of the account limits (see gateway_processes in llm_gateway.py).
+# The deadline is generous since nobody is waiting on the other end.
+gateway = LLM_Gateway(model_limits=course_data.get('llm_limits'), deadline=600)
+
 db_path = course_data['db_file']
 db_temp_path = db_path + '.tmp'
 db_folder = course_data['db_folder']
@@ -87,10 +91,9 @@ def process_file(filename):
     Finally, list 5 or fewer keywords for the document's content.
     Your entire response should be one line.
     """
-    client = openai.OpenAI()
     if len(document_text) > 5000: document_text = document_text[0:5000]
     description_messages = [{"role":"system","content":description_prompt} , {"role":"user","content":document_text}]
-    description = client.chat.completions.create(
+    description = gateway.chat(
         model="gpt-4o-mini",
         messages=description_messages,
         max_tokens=200,
@@ -102,7 +105,7 @@ def process_file(filename):
     embedding_bytes_list = []
     for chunk in chunks:
         # Add each chunk and embeddings into the table of chunks
-        embedding = openai.embeddings.create(model="text-embedding-ada-002",input=chunk).data[0].embedding
+        embedding = gateway.embed(model="text-embedding-ada-002",input=chunk).data[0].embedding
         embedding_bytes = np.array( embedding ).tobytes()
         embedding_bytes_list.append( embedding_bytes )
     # Write to database: save this for the end to keep the lock as brief as possible
@@ -129,6 +132,9 @@ with ThreadPoolExecutor(max_workers=16) as executor:
     executor.map(process_file, filenames)
 
 print(f"Finished importing documents: {datetime.now():%H:%M:%S}")
+print("LLM gateway statistics:")
+for model, model_stats in gateway.stats().items():
+    print(f"          {model}: {json.dumps(model_stats)}")
 
 ## Now that the database construction has ended successfully, overwrite the existing one (if present)
 os.rename(db_temp_path,db_path)
@@ -0,0 +1,288 @@
+import json, time, random, threading, openai, tiktoken
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# Limits for each model across our whole OpenAI account. max_concurrent caps the number of requests in flight at once,
+# and tokens_per_minute caps the estimated tokens (prompt plus max_tokens) admitted in any 60 second window.
+# These should be set a little below the account's rate limits so that we queue instead of getting 429s.
+account_model_limits = {
+    "gpt-4o":                 { "max_concurrent": 32, "tokens_per_minute": 1600000 },
+    "gpt-4o-mini":            { "max_concurrent": 64, "tokens_per_minute": 6000000 },
+    "text-embedding-ada-002": { "max_concurrent": 64, "tokens_per_minute": 3200000 },
+}
+account_fallback_limits = { "max_concurrent": 16, "tokens_per_minute": 400000 }
+
+# The limits are enforced per process: each back.py server and each build_embeddings.py run has its own LLM_Gateway, and they do not
+# coordinate. So by default each process gets an equal share of the account budget: one back.py per course in courses.json (currently three)
+# plus one build_embeddings.py. If the processes should be split differently (e.g. a larger share for the course with exams this week),
+# set "llm_limits" for that course in courses.json, e.g. "llm_limits": {"gpt-4o": {"max_concurrent": 16, "tokens_per_minute": 800000}},
+# keeping the totals over all running processes below the account limits. Any key not given there keeps its default.
+gateway_processes = 4
+
+def share_of_account(limits):
+    return { key: max(value // gateway_processes, 1) for key, value in limits.items() }
+
+default_model_limits = { model: share_of_account(limits) for model, limits in account_model_limits.items() }
+# Used for any model not listed above.
+fallback_model_limits = share_of_account(account_fallback_limits)
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses. Anything else (bad request, auth) is raised immediately.
+retryable_errors = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+# Seconds the server asked us to wait before retrying, from the Retry-After header of the error response, or 0 if it did not say.
+# Connection errors and timeouts have no response, and Retry-After given as an HTTP date is ignored.
+def retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None: return 0
+    try:
+        return max(float(response.headers.get("retry-after", 0)), 0)
+    except ValueError:
+        return 0
+
+# Used only to estimate token counts for the per-minute budget, so it does not need to match each model's tokenizer exactly.
+encoding = tiktoken.get_encoding("cl100k_base")
+
+def estimate_tokens(text):
+    if text is None: return 0
+    if isinstance(text, str): return len(encoding.encode(text))
+    return sum(estimate_tokens(item) for item in text)
+
+
+# Admission control for a single model: a concurrency limit plus a sliding one-minute token budget.
+# Requests are admitted in arrival order: each one takes a ticket, and only the ticket at the head of the line may take capacity,
+# so a large request (e.g. one carrying a whole pasted document) is not overtaken by smaller ones that arrived after it.
+# Waiting threads block on a condition variable until they reach the head and both limits allow them in, or until their deadline passes.
+class Model_Queue:
+
+    def __init__(self, model, max_concurrent, tokens_per_minute):
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self.tokens_per_minute = tokens_per_minute
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.token_log = deque() # (admission time, estimated tokens) for each request admitted in the last minute
+        self.waiters = deque() # tickets of requests in acquire(), in arrival order
+        self.waiting = 0 # requests that actually had to wait, i.e. the queue depth
+        self.stats = { "admitted": 0, "timeouts": 0, "retries": 0, "coalesced": 0, "failures": 0,
+                       "total_wait_seconds": 0.0, "max_wait_seconds": 0.0, "max_queue_depth": 0 }
+
+    def tokens_used(self, now):
+        while self.token_log and now - self.token_log[0][0] >= 60:
+            self.token_log.popleft()
+        return sum(tokens for _, tokens in self.token_log)
+
+    # Block until the request is admitted, or raise TimeoutError once the deadline (a time.monotonic() value) passes.
+    def acquire(self, tokens, deadline):
+        start = time.monotonic()
+        ticket = object()
+        queued = False
+        with self.condition:
+            self.waiters.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    used = self.tokens_used(now)
+                    # A request larger than the whole budget is still let through once the window is empty, otherwise it would never run.
+                    if self.waiters[0] is ticket and self.in_flight < self.max_concurrent and (used + tokens <= self.tokens_per_minute or not self.token_log):
+                        break
+                    if now >= deadline:
+                        self.stats["timeouts"] += 1
+                        self.record_wait(now - start)
+                        raise TimeoutError(f"Timed out waiting for capacity on {self.model}")
+                    # Only count the request as queued once it actually has to wait.
+                    if not queued:
+                        queued = True
+                        self.waiting += 1
+                        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.waiting)
+                    # Wake up when the oldest token entry expires, even if nobody releases a slot in the meantime.
+                    wait = deadline - now
+                    if self.token_log: wait = min(wait, max(60 - (now - self.token_log[0][0]), 0.01))
+                    self.condition.wait(wait)
+            finally:
+                # Whether admitted or timed out, leaving the line may put a new request at its head, so wake the others to check.
+                self.waiters.remove(ticket)
+                if queued: self.waiting -= 1
+                self.condition.notify_all()
+            self.in_flight += 1
+            self.token_log.append((now, tokens))
+            self.stats["admitted"] += 1
+            self.record_wait(now - start)
+
+    # Timed-out requests are included too, since they are the longest waits. Call with self.condition held.
+    def record_wait(self, waited):
+        self.stats["total_wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    # For requests that gave up without going through acquire(), e.g. coalesced requests whose leader took too long.
+    def record_timeout(self, waited):
+        with self.condition:
+            self.stats["timeouts"] += 1
+            self.record_wait(waited)
+
+    def record(self, stat):
+        with self.condition:
+            self.stats[stat] += 1
+
+    def snapshot(self):
+        with self.condition:
+            snapshot = dict(self.stats)
+            snapshot["queue_depth"] = self.waiting
+            snapshot["in_flight"] = self.in_flight
+            snapshot["tokens_last_minute"] = self.tokens_used(time.monotonic())
+            snapshot["max_concurrent"] = self.max_concurrent
+            snapshot["tokens_per_minute"] = self.tokens_per_minute
+            waits = snapshot["admitted"] + snapshot["timeouts"]
+            snapshot["mean_wait_seconds"] = snapshot["total_wait_seconds"] / waits if waits else 0.0
+            return snapshot
+
+
+# Wraps a streaming response so that the model's concurrency slot is released exactly once: when the stream is exhausted, closed, or garbage collected.
+# Closing also closes the upstream stream, so callers that stop reading early (e.g. after the usage chunk) should call close() or use it in a with block.
+class Slot_Stream:
+
+    def __init__(self, stream, queue):
+        self.stream = stream
+        self.iterator = iter(stream)
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.released: return
+            self.released = True
+        try:
+            if hasattr(self.stream, "close"): self.stream.close()
+        finally:
+            self.queue.release()
+
+    def __del__(self):
+        self.close()
+
+
+# Gateway for all outbound LLM calls in one process. Every chat completion and embedding request should go through one instance of this class,
+# so that concurrent Flask requests (or build_embeddings.py worker threads) share the same per-model limits. Other processes have their own
+# instance and their own limits; see gateway_processes above.
+class LLM_Gateway:
+
+    def __init__(self, client=None, model_limits=None, deadline=60, request_timeout=30, max_retries=4, base_backoff=0.5, max_backoff=20):
+        # The client does its own retries by default; turn those off so that every retry goes back through the queue.
+        self.client = client or openai.OpenAI(timeout=request_timeout, max_retries=0)
+        self.model_limits = model_limits or {} # per-course overrides, merged key by key over the defaults in get_queue()
+        self.deadline = deadline # seconds a call may spend queueing and retrying before giving up
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.queues = {}
+        self.queues_lock = threading.Lock()
+        self.in_flight_requests = {} # request key -> Future, for coalescing identical non-streaming requests
+        self.in_flight_lock = threading.Lock()
+
+    def get_queue(self, model):
+        with self.queues_lock:
+            if model not in self.queues:
+                limits = { **fallback_model_limits, **default_model_limits.get(model, {}), **self.model_limits.get(model, {}) }
+                self.queues[model] = Model_Queue(model, limits["max_concurrent"], limits["tokens_per_minute"])
+            return self.queues[model]
+
+    # Call function(), holding a slot on the model's queue for each attempt and retrying retryable errors with jittered exponential backoff.
+    # For streaming calls, the slot is not released here; it is handed back along with the response and released when the stream ends.
+    def call_with_retries(self, model, tokens, deadline, function, hold_slot=False):
+        queue = self.get_queue(model)
+        attempt = 0
+        while True:
+            queue.acquire(tokens, deadline)
+            try:
+                result = function()
+            except retryable_errors as error:
+                queue.release()
+                attempt += 1
+                # "Full jitter": sleep a random time up to the exponential backoff, so that a burst of failed requests does not retry in lockstep.
+                # If the server said how long to wait (usually on a 429), wait at least that long.
+                backoff = max(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)), retry_after(error))
+                if attempt > self.max_retries or time.monotonic() + backoff >= deadline:
+                    queue.record("failures")
+                    raise
+                queue.record("retries")
+                time.sleep(backoff)
+                continue
+            except BaseException:
+                queue.release()
+                queue.record("failures")
+                raise
+            if not hold_slot: queue.release()
+            return result
+
+    # Run a non-streaming request, sharing the result with any identical request that is already in flight.
+    def coalesce(self, model, key, deadline, function):
+        with self.in_flight_lock:
+            future = self.in_flight_requests.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight_requests[key] = future
+        if not leader:
+            queue = self.get_queue(model)
+            queue.record("coalesced")
+            start = time.monotonic()
+            try:
+                return future.result(timeout=max(deadline - start, 0))
+            except FutureTimeoutError:
+                queue.record_timeout(time.monotonic() - start)
+                raise TimeoutError(f"Timed out waiting for a coalesced request on {model}")
+        try:
+            future.set_result(function())
+        except BaseException as error:
+            future.set_exception(error)
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight_requests[key]
+        return future.result()
+
+    # Drop-in replacement for client.chat.completions.create(). Streaming responses are returned as a Slot_Stream, which holds the model's
+    # concurrency slot until the stream is exhausted or closed.
+    def chat(self, deadline=None, **kwargs):
+        model = kwargs["model"]
+        deadline = time.monotonic() + (deadline if deadline is not None else self.deadline)
+        tokens = estimate_tokens([message["content"] for message in kwargs["messages"]]) + kwargs.get("max_tokens", 0)
+        function = lambda: self.client.chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            stream = self.call_with_retries(model, tokens, deadline, function, hold_slot=True)
+            return Slot_Stream(stream, self.get_queue(model))
+        key = json.dumps(["chat", kwargs], sort_keys=True, default=str)
+        return self.coalesce(model, key, deadline, lambda: self.call_with_retries(model, tokens, deadline, function))
+
+    # Drop-in replacement for client.embeddings.create(). Identical in-flight embedding requests (e.g. the same query) share one upstream call.
+    def embed(self, model, input, deadline=None):
+        deadline = time.monotonic() + (deadline if deadline is not None else self.deadline)
+        tokens = estimate_tokens(input)
+        function = lambda: self.client.embeddings.create(model=model, input=input)
+        key = json.dumps(["embed", model, input])
+        return self.coalesce(model, key, deadline, lambda: self.call_with_retries(model, tokens, deadline, function))
+
+    # Queue depth, wait times and retry counts for each model, for sizing capacity.
+    def stats(self):
+        with self.queues_lock:
+            queues = list(self.queues.values())
+        return { queue.model: queue.snapshot() for queue in queues }